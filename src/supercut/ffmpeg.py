@@ -1,10 +1,10 @@
-import concurrent.futures
+import bisect
 import contextlib
 import functools
 import json
 import operator
-import queue
-import socket
+import os
+import shutil
 import subprocess
 import tempfile
 import typing
@@ -17,14 +17,139 @@ import rich.progress
 
 _T = typing.TypeVar("_T")
 
+# Python fds are not inheritable by default, so there's nothing for `close_fds` to
+# close. Turning it off lets `subprocess` use the cheaper `posix_spawn`.
+_SPAWN_KW: dict[str, typing.Any] = {"close_fds": False}
+
+# How far (in ms) a part may start after a keyframe and still be stream-copied.
+KEYFRAME_TOLERANCE_MS = 100
+
+THREADS_ENV_VAR = "SUPERCUT_FFMPEG_THREADS"
+
+# Threads for each ffmpeg run that re-encodes. `None` falls back to
+# `THREADS_ENV_VAR`, and leaves it to ffmpeg if that isn't set either.
+# Stream-copying runs always use a single thread, as they have nothing to spread.
+FFMPEG_THREADS: int | None = None
+
+# Subtitle codecs ffmpeg can convert to other text formats.
+TEXT_SUBTITLE_CODECS = frozenset(
+    {"ass", "ssa", "subrip", "srt", "mov_text", "webvtt", "text"}
+)
+
+# Hardware acceleration methods we know how to encode with, in order of preference.
+# VAAPI is left out, as its encoder needs the frames uploaded to the GPU explicitly.
+HWACCEL_ENCODERS = {
+    "cuda": "h264_nvenc",
+    "qsv": "h264_qsv",
+    "videotoolbox": "h264_videotoolbox",
+}
+
+
+@functools.cache
+def _executable(name: str) -> str:
+    # `subprocess` only uses `posix_spawn` when given a path to the executable.
+    return shutil.which(name) or name
+
 
 def ensure_ffmpeg() -> bool:
+    # Start both checks before waiting on either, so they run side by side.
+    processes = []
     try:
-        subprocess.check_call(["ffmpeg", "-version"], stdout=subprocess.PIPE)
-        subprocess.check_call(["ffprobe", "-version"], stdout=subprocess.PIPE)
-        return True
+        for name in ("ffmpeg", "ffprobe"):
+            processes.append(
+                subprocess.Popen(
+                    [_executable(name), "-version"],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    **_SPAWN_KW,
+                )
+            )
     except Exception:
+        # Don't leave the checks that did start running behind.
+        for process in processes:
+            process.kill()
+            process.wait()
         return False
+    return all([process.wait() == 0 for process in processes])
+
+
+def _can_encode_with(hwaccel: str) -> bool:
+    # Encoding a single generated frame fails fast when the device is missing.
+    process = subprocess.run(
+        [
+            _executable("ffmpeg"),
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=size=256x256",
+            "-frames:v",
+            "1",
+            "-c:v",
+            HWACCEL_ENCODERS[hwaccel],
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        **_SPAWN_KW,
+    )
+    return process.returncode == 0
+
+
+@functools.cache
+def detect_hwaccel() -> str | None:
+    """
+    Return the preferred hardware acceleration method we can encode with,
+    or `None` to encode in software.
+
+    Notes:
+        - ffmpeg lists the methods it was built with, not the ones the hardware
+          has, so each candidate's encoder is tried on a single frame.
+    """
+    output = subprocess.check_output(
+        [_executable("ffmpeg"), "-hide_banner", "-hwaccels"], **_SPAWN_KW
+    )
+    # The first line is a "Hardware acceleration methods:" header.
+    available = set(output.decode().split()[3:])
+    for hwaccel in HWACCEL_ENCODERS:
+        if hwaccel in available and _can_encode_with(hwaccel):
+            return hwaccel
+    return None
+
+
+def validate_hwaccel(hwaccel: str | None) -> str | None:
+    """Raise a `ValueError` unless `hwaccel` is `None`, "auto" or a known method."""
+    if hwaccel is not None and hwaccel != "auto" and hwaccel not in HWACCEL_ENCODERS:
+        raise ValueError(
+            f"Unsupported hwaccel {hwaccel!r}, expected 'auto' or one of"
+            f" {', '.join(HWACCEL_ENCODERS)}"
+        )
+    return hwaccel
+
+
+def resolve_hwaccel(hwaccel: str | None) -> str | None:
+    if validate_hwaccel(hwaccel) == "auto":
+        return detect_hwaccel()
+    return hwaccel
+
+
+def _hwaccel_args(hwaccel: str | None) -> tuple[list[str], list[str]]:
+    """Return the input and output args for encoding with `hwaccel`."""
+    if hwaccel is None:
+        return [], []
+    return ["-hwaccel", hwaccel], ["-c:v", HWACCEL_ENCODERS[hwaccel]]
+
+
+def _threads_args() -> list[str]:
+    threads = FFMPEG_THREADS
+    if threads is None and (env_threads := os.environ.get(THREADS_ENV_VAR)):
+        threads = int(env_threads)
+    if threads is None:
+        return []
+    return ["-threads", str(threads)]
 
 
 def ffmpeg(description: str = ""):
@@ -34,22 +159,34 @@ def ffmpeg(description: str = ""):
         if not description:
             description = f"Running {f.__name__}"
 
-        context_manager = contextlib.contextmanager(f)
-
+        # The decorated function yields its command once, and may clean up
+        # after it (e.g. `hardcode_subs` restores the working directory) when
+        # we close it.
         def as_iterator(key: bytes, converter: typing.Callable[[bytes], _T]):
             @functools.wraps(f)
             def wrapper(*args, **kwargs):
-                with context_manager(*args, **kwargs) as args:
+                command = f(*args, **kwargs)
+                try:
+                    cmd, stdin = _split_stdin(next(command))
                     yield from ffmpeg_progress_iterator(
-                        args, progress_key=key, progress_converter=converter
+                        cmd,
+                        progress_key=key,
+                        progress_converter=converter,
+                        input=stdin,
                     )
+                finally:
+                    command.close()
 
             return wrapper
 
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            with context_manager(*args, **kwargs) as args:
-                subprocess.run(["ffmpeg", *args], capture_output=True, check=True)
+            command = f(*args, **kwargs)
+            try:
+                cmd, stdin = _split_stdin(next(command))
+                run_ffmpeg(cmd, input=stdin)
+            finally:
+                command.close()
 
         wrapper.as_iterator = as_iterator  # type: ignore[attr-defined]
 
@@ -58,185 +195,449 @@ def ffmpeg(description: str = ""):
     return decorator
 
 
-def get_subtitle_stream_id(video: Path, language: str = "eng") -> int:
-    """
-    The subtitle stream index among subtitle streams.
-    This ignores non-subtitle streams.
-    """
-    # First, probe the file to get the right stream
+@functools.lru_cache(maxsize=512)
+def _probe(video: str, mtime_ns: int, size: int) -> dict:
+    # `mtime_ns` and `size` are only here to invalidate the cache when the file
+    # changes.
     process = subprocess.run(
         [
-            "ffprobe",
+            _executable("ffprobe"),
             "-print_format",
             "json",
-            str(video),
+            video,
             "-show_streams",
             "-v",
             "error",
         ],
         capture_output=True,
         check=True,
+        **_SPAWN_KW,
     )
-    probe = json.loads(process.stdout)
+    return json.loads(process.stdout)
+
 
+def probe(video: Path) -> dict:
+    """
+    The ffprobe stream information of the video.
+
+    Results are cached for as long as the file is unchanged, so don't modify them.
+    """
+    stat = video.stat()
+    return _probe(str(video.resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def _split_stdin(
+    command: list[str] | tuple[list[str], bytes],
+) -> tuple[list[str], bytes | None]:
+    """
+    Commands yield either their arguments, or their arguments and the data
+    to feed ffmpeg's stdin.
+    """
+    if isinstance(command, tuple):
+        return command
+    return command, None
+
+
+def run_ffmpeg(args: typing.Iterable[str], input: bytes | None = None) -> None:
+    cmd = [_executable("ffmpeg"), *args]
+    # We only need ffmpeg's output if it fails, so we don't keep it in memory.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.run(
+            cmd, input=input, stdout=subprocess.DEVNULL, stderr=stderr, **_SPAWN_KW
+        )
+        check_returncode(process.returncode, cmd, stderr)
+
+
+def check_returncode(returncode: int, cmd: list[str], stderr: typing.IO[bytes]):
+    """
+    Raise a `CalledProcessError` with the contents of `stderr` if the command failed.
+    """
+    if returncode:
+        stderr.seek(0)
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr.read())
+
+
+def extract_all_subs(video: Path, fmt="ass") -> dict[str, bytes]:
+    """
+    Extract the subs of every language in the video, in a single ffmpeg run.
+
+    Notes:
+        - Only the first subtitle stream of each language is used.
+        - Image-based streams are skipped, as they can't be converted to text.
+    """
     subtitle_streams = [
         stream
-        for stream in probe.get("streams", [])
+        for stream in probe(video).get("streams", [])
         if stream.get("codec_type") == "subtitle"
     ]
+    stream_ids: dict[str, int] = {}
     for i, stream in enumerate(subtitle_streams):
-        if stream.get("tags", {}).get("language") == language:
-            break
-    else:
-        raise RuntimeError()
-
-    return i
-
-
-def extract_subtitle_stream(
-    video: Path,
-    subtitle_stream_id: int,
-    fmt: str = "ass",
-    start: str | None = None,
-    end: str | None = None,
-) -> bytes:
-    input_cmds = []
-    if start:
-        input_cmds.extend(["-ss", start])
-    if end:
-        input_cmds.extend(["-to", end])
-    return subprocess.check_output(
+        language = stream.get("tags", {}).get("language")
+        if language is not None and stream.get("codec_name") in TEXT_SUBTITLE_CODECS:
+            stream_ids.setdefault(language, i)
+
+    if not stream_ids:
+        return {}
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        outputs = {
+            language: Path(tempdir) / f"{i}.{fmt}" for language, i in stream_ids.items()
+        }
+        # Every stream gets its own output, so the video is only read once.
+        cmd = ["-v", "quiet", "-i", str(video)]
+        for language, i in stream_ids.items():
+            cmd.extend(["-map", f"0:s:{i}", "-f", fmt, str(outputs[language])])
+        run_ffmpeg(cmd)
+
+        return {language: output.read_bytes() for language, output in outputs.items()}
+
+
+def _concat_file(video: Path) -> str:
+    # The concat demuxer only escapes quotes by closing and reopening the string.
+    path = str(video.absolute()).replace("'", "'\\''")
+    return f"file '{path}'"
+
+
+# The static parts of the commands are built once, the per-call values are
+# filled in around them.
+
+# The concat list is passed over stdin, so we don't need a temporary file for it.
+_CONCAT_INPUT_ARGS = (
+    "-safe",
+    "0",
+    "-protocol_whitelist",
+    "pipe,file",
+    "-f",
+    "concat",
+    "-i",
+    "pipe:0",
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _keyframe_times(video: str, mtime_ns: int, size: int) -> list[int]:
+    # Like with `_probe`, `mtime_ns` and `size` only invalidate the cache.
+    process = subprocess.run(
         [
-            "ffmpeg",
-            *input_cmds,
-            "-i",
-            str(video),
-            "-map",
-            f"0:s:{subtitle_stream_id}",
-            "-f",
-            fmt,
+            _executable("ffprobe"),
+            "-print_format",
+            "json",
+            "-select_streams",
+            "v:0",
+            "-skip_frame",
+            "nokey",
+            "-show_entries",
+            "frame=best_effort_timestamp_time",
+            video,
             "-v",
-            "quiet",
-            "-",
-        ]
+            "error",
+        ],
+        capture_output=True,
+        check=True,
+        **_SPAWN_KW,
     )
+    probe = json.loads(process.stdout)
 
+    return sorted(
+        int(float(frame["best_effort_timestamp_time"]) * 1000)
+        for frame in probe.get("frames", [])
+        if "best_effort_timestamp_time" in frame
+    )
 
-def extract_subs_by_language(video: Path, language: str = "eng", fmt="ass") -> bytes:
-    subtitle_stream_id = get_subtitle_stream_id(video, language=language)
-
-    # Then we extract it to stdout
-    raw_subs = extract_subtitle_stream(video, subtitle_stream_id, fmt=fmt)
-    return raw_subs
 
+def get_keyframe_times(video: Path) -> list[int]:
+    """
+    The keyframe timestamps of the first video stream, in milliseconds.
 
-@ffmpeg()
-def concat_videos(videos: list[Path], output: Path):
-    concat_list = (f"file '{video.absolute()!s}'" for video in videos)
-    concat_text = "\n".join(concat_list)
+    This reads through the whole video, so results are cached for as long as
+    the file is unchanged. Don't modify them.
+    """
+    stat = video.stat()
+    return _keyframe_times(str(video.resolve()), stat.st_mtime_ns, stat.st_size)
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        list_path = Path(tempdir) / "list.txt"
-        list_path.write_text(concat_text)
-        yield [
-            "-safe",
-            "0",
-            "-f",
-            "concat",
-            "-i",
-            str(list_path),
-            str(output),
-        ]
 
+def is_keyframe_aligned(
+    video_parts: list["VideoPart"],
+    tolerance_ms: int = KEYFRAME_TOLERANCE_MS,
+    keyframe_times: typing.Callable[[Path], list[int]] = get_keyframe_times,
+) -> bool:
+    """
+    Whether all the parts start on (or just after) a keyframe.
 
-def validate_video(video: Path):
-    subprocess.run(["ffprobe", str(video)], capture_output=True, check=True)
+    When stream-copying, a part starts at the keyframe preceding its start,
+    so this tells us whether copying is accurate enough.
+    Videos are scanned one at a time, and we stop at the first misaligned part.
+    """
+    parts_by_video: dict[Path, list[VideoPart]] = {}
+    for part in video_parts:
+        parts_by_video.setdefault(part.video, []).append(part)
+
+    for video, parts in parts_by_video.items():
+        times = keyframe_times(video)
+        for part in parts:
+            index = bisect.bisect_right(times, part.start)
+            if index == 0 or part.start - times[index - 1] > tolerance_ms:
+                return False
+    return True
+
+
+def _codec_signature(video: Path) -> tuple:
+    streams = probe(video).get("streams", [])
+    signature = []
+    for codec_type, keys in [
+        ("video", ("codec_name", "width", "height", "pix_fmt")),
+        ("audio", ("codec_name", "sample_rate", "channels")),
+    ]:
+        stream: dict = next(
+            (s for s in streams if s.get("codec_type") == codec_type), {}
+        )
+        signature.append(tuple(stream.get(key) for key in keys))
+    return tuple(signature)
+
+
+def have_matching_codecs(videos: typing.Iterable[Path]) -> bool:
+    """
+    Whether the first video and audio streams of all the videos can be
+    concatenated without re-encoding.
+    """
+    return len({_codec_signature(video) for video in videos}) <= 1
+
+
+_CONCAT_PARTS_OUTPUT_ARGS = (
+    "-map",
+    "0:v:0",
+    "-map",
+    "0:a:0",
+    "-map",
+    "1",
+    "-c",
+    "copy",
+    "-threads",
+    "1",
+    "-avoid_negative_ts",
+    "make_zero",
+    "-disposition:s:0",
+    "default",
+)
 
 
 @ffmpeg()
-def trim_video(video: Path, start: int, end: int, output: Path):
-    filter_command = (
-        f"[0:v]trim={0}:{end - start}ms,setpts=PTS-STARTPTS[video];"
-        f"[0:a]atrim={0}:{end - start}ms,asetpts=PTS-STARTPTS[audio];"
+def concat_parts(video_parts: list["VideoPart"], subs: Path, output: Path):
+    """
+    Stream-copy the parts straight from their videos into a single video, with
+    `subs` muxed in, in one ffmpeg run.
+
+    Notes:
+        - Every part starts at the keyframe preceding its start, but is placed
+          on the timeline by its declared duration, same as with `merge_subs`.
+    """
+    # Supercuts reuse a few videos many times, so each is only resolved once.
+    files = {
+        video: _concat_file(video) for video in {part.video for part in video_parts}
+    }
+    concat_text = "\n".join(
+        f"{files[part.video]}\n"
+        f"inpoint {part.start / 1000}\n"
+        f"outpoint {part.end / 1000}"
+        for part in video_parts
     )
-    cmd = [
+
+    yield [
         "-v",
         "quiet",
-        "-ss",
-        f"{start}ms",
+        "-fflags",
+        "+genpts",
+        *_CONCAT_INPUT_ARGS,
         "-i",
-        str(video),
+        str(subs),
+        *_CONCAT_PARTS_OUTPUT_ARGS,
+        str(output),
+    ], concat_text.encode("utf8")
+
+
+@attrs.frozen
+class OutputFormat:
+    """The frame size and audio layout every re-encoded part is converted to."""
+
+    width: int
+    height: int
+    sample_rate: int
+    channel_layout: str | None = None
+
+    @classmethod
+    def of(cls, video: Path) -> "OutputFormat":
+        streams = probe(video).get("streams", [])
+        video_stream: dict = next(
+            (s for s in streams if s.get("codec_type") == "video"), {}
+        )
+        audio_stream: dict = next(
+            (s for s in streams if s.get("codec_type") == "audio"), {}
+        )
+        return cls(
+            width=int(video_stream["width"]),
+            height=int(video_stream["height"]),
+            sample_rate=int(audio_stream.get("sample_rate", 48000)),
+            channel_layout=audio_stream.get("channel_layout"),
+        )
+
+
+def _normalize_filters(i: int, output_format: OutputFormat) -> str:
+    """
+    The filters that convert the `i`th input to `output_format`, as the concat
+    filter needs all its segments to match.
+    """
+    width, height = output_format.width, output_format.height
+    audio_filters = [f"aresample={output_format.sample_rate}"]
+    if output_format.channel_layout:
+        audio_filters.append(f"aformat=channel_layouts={output_format.channel_layout}")
+    return (
+        f"[{i}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+        f"setpts=PTS-STARTPTS[v{i}];"
+        f"[{i}:a:0]{','.join(audio_filters)},asetpts=PTS-STARTPTS[a{i}];"
+    )
+
+
+@ffmpeg()
+def trim_and_concat(
+    video_parts: list["VideoPart"],
+    output: Path,
+    output_format: OutputFormat,
+    subs: Path | None = None,
+    hwaccel: str | None = None,
+):
+    """
+    Re-encode the parts into a single video, with `subs` muxed in if given,
+    in one ffmpeg run.
+
+    Every part gets its own seeked input, so only the frames we keep are decoded.
+    Each one is scaled and padded to `output_format`, and the concat filter
+    joins them before they are encoded once.
+
+    Notes:
+        - Every part is a separate input, with its own decoder, so callers should
+          keep the number of parts bounded, see `MAX_PARTS_PER_RUN`.
+    """
+    input_args, output_args = _hwaccel_args(hwaccel)
+    inputs = []
+    filters = []
+    for i, part in enumerate(video_parts):
+        inputs.extend(
+            [
+                *input_args,
+                "-ss",
+                f"{part.start}ms",
+                "-t",
+                f"{part.duration_ms}ms",
+                "-i",
+                str(part.video),
+            ]
+        )
+        filters.append(_normalize_filters(i, output_format))
+    streams = "".join(f"[v{i}][a{i}]" for i in range(len(video_parts)))
+    filters.append(f"{streams}concat=n={len(video_parts)}:v=1:a=1[video][audio]")
+
+    subs_args = []
+    if subs is not None:
+        subs_args = ["-map", str(len(video_parts)), "-c:s", "copy"]
+        subs_args.extend(["-disposition:s:0", "default"])
+
+    yield [
+        "-v",
+        "quiet",
+        *inputs,
+        *(["-i", str(subs)] if subs is not None else []),
         "-filter_complex",
-        filter_command,
+        "".join(filters),
         "-map",
         "[video]",
         "-map",
         "[audio]",
+        *output_args,
+        *_threads_args(),
+        *subs_args,
         str(output),
     ]
-    yield cmd
 
 
 @ffmpeg()
-def add_subs(video: Path, subs: Path, output: Path):
-    # Then add the subs to the video
+def concat_batches(batches: list[Path], subs: Path, output: Path):
+    """
+    Stream-copy the batches rendered by `trim_and_concat` into a single video,
+    with `subs` muxed in.
+    """
+    concat_text = "\n".join(_concat_file(batch) for batch in batches)
     yield [
-        "-i",
-        str(video),
+        "-v",
+        "quiet",
+        *_CONCAT_INPUT_ARGS,
         "-i",
         str(subs),
-        "-c",
-        "copy",
-        "-disposition:s:0",
-        "default",
+        *_CONCAT_PARTS_OUTPUT_ARGS,
         str(output),
-    ]
+    ], concat_text.encode("utf8")
 
 
-def add_subs_from_string(video: Path, subs: str, output: Path):
-    validate_video(video)
-    with tempfile.TemporaryDirectory() as tempdir:
-        subs_file = Path(tempdir) / "subs.ssa"
-        subs_file.write_text(subs)
+# The most parts we decode in a single ffmpeg run when re-encoding. Each part
+# is an input, with its own demuxer, decoder and (with hwaccel) device context.
+MAX_PARTS_PER_RUN = 16
 
-        add_subs(video, subs_file, output)
 
+def render_reencoded(
+    video_parts: list["VideoPart"],
+    subs: Path,
+    output: Path,
+    hwaccel: str | None = None,
+) -> Iterator[int]:
+    """
+    Re-encode the parts into `output`, yielding the progress in microseconds.
 
-@ffmpeg()
-def replace_subs(video, subs, output):
-    # Then add the subs to the video
-    yield [
-        "-i",
-        str(video),
-        "-i",
-        str(subs),
-        "-map",
-        "0:a",
-        "-map",
-        "0:v",
-        "-map",
-        "1",
-        "-disposition:s:0",
-        "default",
-        "-c",
-        "copy",
-        str(output),
-    ]
+    The parts are converted to the format of the first part's video. Up to
+    `MAX_PARTS_PER_RUN` parts are rendered in one run; longer supercuts are
+    rendered in batches which are then stream-copied together.
+    """
+    output_format = OutputFormat.of(video_parts[0].video)
+    render = functools.partial(
+        trim_and_concat.as_iterator(key=b"out_time_us", converter=int),
+        output_format=output_format,
+        hwaccel=hwaccel,
+    )
+    if len(video_parts) <= MAX_PARTS_PER_RUN:
+        yield from render(video_parts, output, subs=subs)
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        batches: list[Path] = []
+        done_us = 0
+        for start in range(0, len(video_parts), MAX_PARTS_PER_RUN):
+            batch_parts = video_parts[start : start + MAX_PARTS_PER_RUN]
+            # Same container as the output, so the batches can be copied as-is.
+            batch = Path(tempdir) / f"batch{len(batches)}{output.suffix}"
+            for out_time_us in render(batch_parts, batch):
+                yield done_us + out_time_us
+            done_us += sum(part.duration_us for part in batch_parts)
+            batches.append(batch)
+
+        concat_batches(batches, subs, output)
 
 
 @attrs.frozen
 class VideoPart:
     video: Path
-    subs: str
+    # Trimmed to the part. Only serialized once all the parts are merged.
+    subs: pysubs2.SSAFile = attrs.field(eq=False)
     start: int
     end: int
+    # Computed once, as they're summed over all parts a few times during a render
+    duration_ms: int = attrs.field(init=False)
+    duration_us: int = attrs.field(init=False)
 
-    @property
-    def duration_ms(self):
+    @duration_ms.default
+    def _duration_ms(self) -> int:
         return self.end - self.start
 
-    @property
-    def duration_us(self):
+    @duration_us.default
+    def _duration_us(self) -> int:
         return self.duration_ms * 1000
 
 
@@ -249,123 +650,149 @@ def progress_tracker(description: str, total: float | None = None):
         progress.update(task, completed=total)
 
 
-def supercut_free(video_parts: list[VideoPart], output: Path):
-    trim_video_generator = trim_video.as_iterator(key=b"out_time_us", converter=int)
-    concat_videos_generator = concat_videos.as_iterator(
-        key=b"out_time_us", converter=int
-    )
+def supercut_free(
+    video_parts: list[VideoPart],
+    output: Path,
+    reencode: bool | None = None,
+    hwaccel: str | None = None,
+    keyframe_times: typing.Callable[[Path], list[int]] = get_keyframe_times,
+):
+    """
+    Notes:
+        - With `reencode=None`, the parts are stream-copied only if the videos
+          share their codecs and all the parts start on keyframes, and
+          re-encoded otherwise. `keyframe_times` lets callers cache the
+          keyframes across runs.
+        - `hwaccel` is used for re-encoding the parts, see `resolve_hwaccel`.
+    """
+    if reencode is None:
+        reencode = not (
+            have_matching_codecs({part.video for part in video_parts})
+            and is_keyframe_aligned(video_parts, keyframe_times=keyframe_times)
+        )
+
+    render_generator: typing.Callable[[list[VideoPart], Path, Path], Iterator[int]]
+    if reencode:
+        render_generator = functools.partial(
+            render_reencoded, hwaccel=resolve_hwaccel(hwaccel)
+        )
+    else:
+        render_generator = concat_parts.as_iterator(key=b"out_time_us", converter=int)
 
-    concat_list = []
-    video_suffix = output.suffix
     total_out_time_us = sum(part.duration_us for part in video_parts)
 
+    # Either way, the parts are only read once, on their way to `output`.
     with tempfile.TemporaryDirectory() as tempdir:
-        temp = Path(tempdir)
-
+        subs = Path(tempdir) / "subs.ssa"
+        merge_subs(video_parts).save(str(subs))
         with progress_tracker(
-            "Extracting video parts", total=float(total_out_time_us)
+            "Rendering video parts", total=float(total_out_time_us)
         ) as update:
-            current_out_time_us = 0
-            for i, part in enumerate(video_parts):
-                trimmed_video = temp / f"trim{i:04}{video_suffix}"
-                for out_time_us in trim_video_generator(
-                    video=part.video,
-                    start=part.start,
-                    end=part.end,
-                    output=trimmed_video,
-                ):
-                    update(completed=current_out_time_us + out_time_us)
-
-                current_out_time_us += part.duration_us
-
-                with_subs = temp / f"withsubs{i:04}{video_suffix}"
-                add_subs_from_string(trimmed_video, part.subs, with_subs)
-                concat_list.append(with_subs)
-
-        dirty_subs = temp / f"dirty{video_suffix}"
-
-        with progress_tracker(
-            "Concatenating video parts", total=float(total_out_time_us)
-        ) as update:
-            for out_time_us in concat_videos_generator(concat_list, dirty_subs):
+            for out_time_us in render_generator(video_parts, subs, output):
                 update(completed=out_time_us)
 
-        cleanup_subs(dirty_subs, output)
-
 
-def cleanup_subs(video: Path, output: Path):
-    subs = pysubs2.SSAFile.from_string(extract_subtitle_stream(video, 0).decode("utf8"))
-    subs.events = sorted(subs.events, key=operator.attrgetter("start"))
+def merge_subs(video_parts: list[VideoPart]) -> pysubs2.SSAFile:
+    """
+    Concatenate the subs of the parts, as if every part lasts exactly its duration.
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        new_subs = Path(tempdir) / "new_subs.ssa"
-        subs.save(str(new_subs))
-        replace_subs(video, new_subs, output)
+    Notes:
+        - Like with the concat demuxer, the file info and conflicting styles are
+          taken from the first part.
+    """
+    merged = pysubs2.SSAFile()
+    merged.styles.clear()
+    offset = 0
+    for i, part in enumerate(video_parts):
+        # The parts' subs may share events, so they are copied before shifting.
+        if i == 0:
+            merged.info = dict(part.subs.info)
+        for name, style in part.subs.styles.items():
+            merged.styles.setdefault(name, style)
+        for event in part.subs.events:
+            event = event.copy()
+            event.start += offset
+            event.end += offset
+            merged.events.append(event)
+        offset += part.duration_ms
+
+    merged.events.sort(key=operator.attrgetter("start"))
+    return merged
 
 
 @ffmpeg()
-def hardcode_subs(video: Path, output: Path):
+def hardcode_subs(video: Path, output: Path, hwaccel: str | None = None):
     abs_video = video.absolute()
     abs_output = output.absolute()
+    input_args, output_args = _hwaccel_args(resolve_hwaccel(hwaccel))
     with contextlib.chdir(video.parent):
-        yield ["-i", str(abs_video), "-vf", f"subtitles={video.name}", str(abs_output)]
+        yield [
+            *input_args,
+            "-i",
+            str(abs_video),
+            "-vf",
+            f"subtitles={video.name}",
+            *output_args,
+            *_threads_args(),
+            str(abs_output),
+        ]
+
 
+_PROGRESS_PREFIX = b"progress="
 
-def recv_progress(conn: socket.socket) -> Iterator[dict]:
-    for data in iter(lambda: conn.recv(1024), b""):
-        yield parse_progress(data)
 
+def recv_progress(stream: typing.IO[bytes], key: bytes) -> Iterator[bytes]:
+    """
+    Yield the value of `key` from each progress report ffmpeg writes to the stream.
 
-def parse_progress(progress: bytes) -> dict:
-    raw_values = dict(line.split(b"=") for line in progress.splitlines())
-    # There are more fields, but we ignore them.
-    # It seems that `out_time_ms` yields th same values as `out_time_us`,
-    # and both are microseconds and not milliseconds.
-    return {key: value.strip() for key, value in raw_values.items()}
+    Reading by lines means reports split across reads are still parsed whole.
+    Reports without `key` are skipped.
+    """
+    prefix = key + b"="
+    value = None
+    for line in stream:
+        if line.startswith(prefix):
+            value = line[len(prefix) :].strip()
+        # ffmpeg ends every report with `progress=continue` or `progress=end`
+        elif line.startswith(_PROGRESS_PREFIX):
+            if value is not None:
+                yield value
+            value = None
 
 
 def ffmpeg_progress_iterator(
     args: typing.Iterable[str],
     progress_key: bytes,
     progress_converter: typing.Callable[[bytes], _T],
+    input: bytes | None = None,
 ) -> typing.Iterator[_T]:
-    with socket.socket() as server:
-        server.bind(("localhost", 0))
-        server.listen(1)
-        host, port = server.getsockname()
-
-        def run_ffmpeg():
-            # We run in a thread, as we need to keep reading the output to avoid
-            # blocking the pipe.
-            subprocess.run(
-                ["ffmpeg", "-progress", f"tcp://{host}:{port}", *args],
-                capture_output=True,
-                check=True,
-            )
-
-        progress_queue: queue.SimpleQueue[_T | None] = queue.SimpleQueue()
-
-        def advance():
-            try:
-                server.settimeout(1)
-                conn, _addr = server.accept()
-
-                with conn:
-                    for step_progress in recv_progress(conn):
-                        # TODO: yield the full progress dict, perform the parsing outside.
-                        step_value = step_progress.get(progress_key)
-                        if step_value is None or step_value == b"N/A":
-                            continue
-                        progress_queue.put(progress_converter(step_value))
-            finally:
-                progress_queue.put(None)
-
-        # We're using a ThreadPoolExecutor for an easy way to get the exceptions in the main thread.
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            advance_future = executor.submit(advance)
-            ffmpeg_future = executor.submit(run_ffmpeg)
-
-            yield from iter(progress_queue.get, None)
-
-            ffmpeg_future.result()
-            advance_future.result()
+    cmd = [_executable("ffmpeg"), "-progress", "pipe:1", *args]
+    # stderr goes to a file and not a pipe, so that it can never fill up and block
+    # ffmpeg while we're busy reading the progress from stdout.
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            **_SPAWN_KW,
+        ) as process:
+            if input is not None:
+                assert process.stdin is not None
+                # Our stdin input (the concat list) is read in full before ffmpeg
+                # reports any progress, so writing it up-front can't deadlock.
+                try:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    # ffmpeg exited early, we raise the error from its returncode.
+                    with contextlib.suppress(BrokenPipeError):
+                        process.stdin.close()
+
+            assert process.stdout is not None
+            for step_value in recv_progress(process.stdout, progress_key):
+                if step_value == b"N/A":
+                    continue
+                yield progress_converter(step_value)
+
+        check_returncode(process.returncode, cmd, stderr)
@@ -1,22 +1,28 @@
+import functools
+import io
 from pathlib import Path
-from typing import Iterator
+from typing import TextIO
 
 import attrs
 
 from supercut import ffmpeg
 
+# Escaping tables for `str.translate`, which escapes in a single pass.
+_ATTRIBUTE_ESCAPES = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "\n": "&#10;"}
+)
+_TEXT_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
 
-def ms_to_timecode(time_ms: int) -> str:
-    total_seconds = time_ms / 1000
-    seconds = total_seconds % 60
-    minutes = int((total_seconds // 60) % 60)
-    hours = int(total_seconds // 3600)
-
-    return f"{hours:02}:{minutes:02}:{seconds:06.3f}"
 
+# Parts often share their boundaries, e.g. when a line is used more than once.
+@functools.lru_cache(maxsize=4096)
+def ms_to_timecode(time_ms: int) -> str:
+    # Integer math only, so there's no float rounding in the output.
+    hours, rest = divmod(time_ms, 3_600_000)
+    minutes, rest = divmod(rest, 60_000)
+    seconds, ms = divmod(rest, 1000)
 
-def indent(line: str) -> str:
-    return "  " + line
+    return f"{hours:02}:{minutes:02}:{seconds:02}.{ms:03}"
 
 
 @attrs.frozen
@@ -24,25 +30,40 @@ class Element:
     tag: str
     attributes: dict[str, str]
     children: list["Element"] | str | None = None
+    # The tag and its escaped attributes, formatted once when the element is built
+    _start_tag: str = attrs.field(init=False, repr=False, eq=False)
 
-    def to_xml(self) -> Iterator[str]:
+    @_start_tag.default
+    def _format_start_tag(self) -> str:
         attributes = " ".join(
-            f'{name}="{value}"' for name, value in self.attributes.items()
+            f'{name}="{value.translate(_ATTRIBUTE_ESCAPES)}"'
+            for name, value in self.attributes.items()
         )
+        return f"<{self.tag} {attributes}"
+
+    def to_xml(self) -> str:
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+    def write(self, out: TextIO, depth: int = 0) -> None:
+        # Every line is indented once, instead of once per enclosing element.
+        indent = "  " * depth
 
         if self.children is None:
-            yield f"<{self.tag} {attributes}/>"
+            out.write(f"{indent}{self._start_tag}/>\n")
 
         elif isinstance(self.children, str):
-            yield f"<{self.tag} {attributes}>{self.children}</{self.tag}>"
+            text = self.children.translate(_TEXT_ESCAPES)
+            out.write(f"{indent}{self._start_tag}>{text}</{self.tag}>\n")
 
         else:
-            yield f"<{self.tag} {attributes}>"
+            out.write(f"{indent}{self._start_tag}>\n")
 
             for child in self.children:
-                yield from map(indent, child.to_xml())
+                child.write(out, depth + 1)
 
-            yield f"</{self.tag}>"
+            out.write(f"{indent}</{self.tag}>\n")
 
 
 def make_chain(*, id_: str, resource: Path) -> Element:
@@ -105,6 +126,9 @@ def make_playlist(
 ) -> list[Element]:
     chains: list[Element] = []
     playlist_entries = []
+    # Every entry gets its own chain, even for the same video. Shotcut attaches
+    # filters to the chain, so a shared one would apply a filter added to one
+    # clip to every clip from that video.
     for i, part in enumerate(parts):
         chain_id = f"{playlist_id}_chain{i}"
         chains.append(make_chain(id_=chain_id, resource=part.video))
@@ -158,4 +182,7 @@ def write_mlt(parts: list[ffmpeg.VideoPart]) -> str:
         children=[*main_bin, background, *playlist, tractor],
     )
 
-    return '<?xml version="1.0" standalone="no"?>\n' + "\n".join(mlt.to_xml())
+    out = io.StringIO()
+    out.write('<?xml version="1.0" standalone="no"?>\n')
+    mlt.write(out)
+    return out.getvalue()
@@ -12,18 +12,14 @@ def _find_in_subs_dir(video: Path, language: str) -> Path | None:
     if not subs_dir.is_dir():
         return None
 
-    # Use sorting to prefer non-SDH subs
-    return next(
-        iter(
-            sorted(
-                subs_dir.glob(f"*.{language}.srt"),
-                # For some reason, mypy thinks we can get a `None` value from the glob.
-                key=_is_sdh,  # type: ignore[arg-type]
-                reverse=True,
-            )
-        ),
-        None,
-    )
+    # Prefer non-SDH subs, falling back to the first SDH ones
+    fallback = None
+    for subs in subs_dir.glob(f"*.{language}.srt"):
+        if not _is_sdh(subs):
+            return subs
+        if fallback is None:
+            fallback = subs
+    return fallback
 
 
 def find_srt_subs_for(video: Path, language: str = "eng") -> Path | None:
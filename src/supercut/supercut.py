@@ -1,14 +1,19 @@
+import bisect
+import concurrent.futures
+import contextlib
+import hashlib
 import io
 import operator
+import os
+import re
 import sys
 import typing
-from collections import defaultdict
-from copy import deepcopy
+from collections import Counter
+from copy import copy
 from pathlib import Path
 from typing import Optional
 
 import attrs
-import diskcache  # type: ignore[import-untyped]
 import more_itertools
 import pysubs2  # type: ignore[import-untyped]
 import rich.console
@@ -19,6 +24,34 @@ import typer
 from supercut import ffmpeg, mlt, vlc
 from supercut.subtitles import get_external_subs
 
+if typing.TYPE_CHECKING:
+    import diskcache  # type: ignore[import-untyped]
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+JOBS_ENV_VAR = "SUPERCUT_JOBS"
+# How many videos to extract subs from at once. Set by the CLI.
+JOBS: int | None = None
+
+_FINGERPRINT_CHUNK_SIZE = 2**20
+
+
+def _video_fingerprint(video: Path) -> str:
+    """
+    Identify a video by its size and the data at both of its ends.
+
+    Unlike its path, this survives renaming and moving the video around.
+    """
+    size = video.stat().st_size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with video.open("rb") as f:
+        digest.update(f.read(_FINGERPRINT_CHUNK_SIZE))
+        if size > _FINGERPRINT_CHUNK_SIZE:
+            f.seek(max(_FINGERPRINT_CHUNK_SIZE, size - _FINGERPRINT_CHUNK_SIZE))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
 app = typer.Typer(
     help="Subtitle-based automatic supercut generator",
     pretty_exceptions_show_locals=False,
@@ -34,27 +67,76 @@ app.add_typer(util_app, name="util")
 
 @attrs.define
 class Core:
-    _cache: diskcache.Cache
+    _cache: "diskcache.Cache"
     _external_subs: bool
 
     @classmethod
     def from_dir(cls, cache_dir: Path | None, external_subs: bool = False) -> "Core":
+        # Imported here, as it's slow to import and only the commands that read
+        # subs need it.
+        import diskcache
+
         return Core(
-            cache=diskcache.Cache(str(cache_dir) if cache_dir is not None else None),
+            cache=diskcache.Cache(
+                str(cache_dir) if cache_dir is not None else None,
+                # Subtitle tracks are usually a few hundred KiB, keep them in
+                # the database instead of a separate file per entry.
+                disk_min_file_size=2**20,
+                sqlite_cache_size=-(2**16),  # 64 MiB, in KiB.
+            ),
             external_subs=external_subs,
         )
 
+    @property
+    def external_subs(self) -> bool:
+        return self._external_subs
+
     def get_subs(self, video: Path, language: str) -> pysubs2.SSAFile:
         if self._external_subs:
             return get_external_subs(video, language)
 
-        @self._cache.memoize(tag="raw_subs")
-        def _get_raw_subs(video_, language_):
-            return ffmpeg.extract_subs_by_language(
-                video_, language=language_, fmt="ass"
-            ).decode("utf8")
-
-        return pysubs2.SSAFile.from_string(_get_raw_subs(video, language))
+        fingerprint = _video_fingerprint(video)
+
+        # Parsing takes a while too, so the parsed subs are cached as well.
+        # They are pickled, so the pysubs2 version is part of the key.
+        parsed_key = ("parsed_subs", fingerprint, language, pysubs2.VERSION)
+        subs = self._cache.get(parsed_key)
+        if subs is not None:
+            return subs
+
+        # All the languages are extracted and cached together, so switching
+        # languages doesn't read the video again.
+        key = ("raw_subs_v2", fingerprint)
+        all_raw_subs = self._cache.get(key)
+        if all_raw_subs is None:
+            all_raw_subs = ffmpeg.extract_all_subs(video, fmt="ass")
+            self._cache.set(key, all_raw_subs, tag="raw_subs_v2")
+
+        if language not in all_raw_subs:
+            raise RuntimeError(f"Failed to find {language} subs in {video}")
+
+        # Parse straight from the cached bytes instead of decoding them to a
+        # string first.
+        with io.TextIOWrapper(
+            io.BytesIO(all_raw_subs[language]),
+            encoding="utf-8",
+            errors="replace",
+            newline="",
+        ) as stream:
+            subs = pysubs2.SSAFile.from_file(stream, format_="ass")
+
+        self._cache.set(parsed_key, subs, tag="parsed_subs")
+        return subs
+
+    def get_keyframe_times(self, video: Path) -> list[int]:
+        # Finding the keyframes reads through the whole video, so they are kept
+        # across runs, like the subs.
+        key = ("keyframes", _video_fingerprint(video))
+        keyframe_times = self._cache.get(key)
+        if keyframe_times is None:
+            keyframe_times = ffmpeg.get_keyframe_times(video)
+            self._cache.set(key, keyframe_times, tag="keyframes")
+        return keyframe_times
 
     def __enter__(self):
         self._cache.__enter__()
@@ -72,51 +154,95 @@ def get_sections(subs: pysubs2.SSAFile, query: str, *, name: str | None = None):
 
 
 def query_events(subs: pysubs2.SSAFile, query: str, *, name: str | None = None):
-    events = []
+    # An empty query matches everything, so we don't search at all.
     lowered_query = query.lower()
-    for event in subs.events:
-        if name is not None and name.lower() != event.name.lower():
-            continue
-        if lowered_query in event.text.lower():
-            events.append(event)
-    return events
+    if name is None:
+        if not lowered_query:
+            return list(subs.events)
+        return [event for event in subs.events if lowered_query in event.text.lower()]
+
+    lowered_name = name.lower()
+    return [
+        event
+        for event in subs.events
+        if lowered_name == event.name.lower() and lowered_query in event.text.lower()
+    ]
 
 
-def copy_subs(subs: pysubs2.SSAFile) -> pysubs2.SSAFile:
-    return deepcopy(subs)
+def format_event(event: pysubs2.SSAEvent) -> str:
+    # Squash line breaks and runs of spaces, so each event fits on one line.
+    text = _WHITESPACE_RE.sub(" ", event.plaintext).strip()
+    return f"{event.name}: {text}"
 
 
-def trim_subs(subs: pysubs2.SSAFile, start: int, end: int) -> pysubs2.SSAFile:
+def format_list(events: typing.Iterable[pysubs2.SSAEvent]) -> typing.Iterator[str]:
+    """
+    Yield the lines listing `events`, numbered the way edit lists refer to them.
     """
+    for i, event in enumerate(events):
+        yield f"{i:-4} | {format_event(event)}\n"
+
+
+def _offset_event(event: pysubs2.SSAEvent, offset: int):
+    event = event.copy()
+    event.start += offset
+    event.end += offset
+    return event
+
+
+def _is_in_range(event: pysubs2.SSAEvent, start: int, end: int):
+    return event.start < end and event.end > start
+
+
+def _squeeze_event(event: pysubs2.SSAEvent, start: int, end: int) -> pysubs2.SSAEvent:
+    event.start = max(event.start, start)
+    event.end = min(event.end, end)
+    return event
+
+
+def subs_trimmer(
+    subs: pysubs2.SSAFile,
+) -> typing.Callable[[int, int], pysubs2.SSAFile]:
+    """
+    Return a function that trims `subs` to a range.
+
+    The trimmed events are offset to start at 0 and cut to the range.
+    Events are indexed by start time, so each range only looks at the events
+    that can overlap it, instead of scanning all of them.
+
     Notes:
         - If a video has subs that exceed its end, it will trail "nothing"
           when concatenated with other files.
     """
-    subs = copy_subs(subs)
-
-    def offset_event(event: pysubs2.SSAEvent, offset: int):
-        event = event.copy()
-        event.start += offset
-        event.end += offset
-        return event
-
-    def is_in_range(event: pysubs2.SSAEvent, start: int, end: int):
-        return event.start < end and event.end > start
-
-    def squeeze_event(
-        event: pysubs2.SSAEvent, start: int, end: int
-    ) -> pysubs2.SSAEvent:
-        event.start = max(event.start, start)
-        event.end = min(event.end, end)
-        return event
-
-    subs.events = [
-        squeeze_event(offset_event(event, -start), 0, end - start)
-        for event in subs.events
-        if is_in_range(event, start, end)
-    ]
+    events = subs.events
+    by_start = sorted(range(len(events)), key=lambda i: events[i].start)
+    starts = [events[i].start for i in by_start]
+    # An event overlapping a range can't start more than this before it.
+    longest = max([0, *(event.end - event.start for event in events)])
+
+    def trim(start: int, end: int) -> pysubs2.SSAFile:
+        lo = bisect.bisect_right(starts, start - longest)
+        hi = bisect.bisect_left(starts, end)
+        # Keep the original event order, as it affects how ASS lays them out.
+        in_range = sorted(
+            i for i in by_start[lo:hi] if _is_in_range(events[i], start, end)
+        )
+
+        trimmed = copy(subs)
+        trimmed.events = [
+            _squeeze_event(_offset_event(events[i], -start), 0, end - start)
+            for i in in_range
+        ]
+        return trimmed
+
+    return trim
+
 
-    return subs
+def _validate_hwaccel(hwaccel: str | None) -> str | None:
+    try:
+        return ffmpeg.validate_hwaccel(hwaccel)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from e
 
 
 @app.command()
@@ -158,13 +284,26 @@ def preview(
 def get_all_subs(
     videos: list[Path], core: Core, language: str
 ) -> list[pysubs2.SSAFile]:
-    subs = []
-    with rich.progress.Progress() as progress:
+    # Extracting the subs is mostly ffmpeg reading through the video, so we fetch
+    # them side by side. External subs are small files that we parse in Python,
+    # where threads would only contend for the GIL.
+    if core.external_subs:
+        max_workers = 1
+    elif JOBS is not None:
+        max_workers = JOBS
+    else:
+        max_workers = max(1, min(len(videos), 2 * (os.cpu_count() or 1)))
+    with (
+        # Each video takes seconds, there's no point in redrawing 10 times a second.
+        rich.progress.Progress(refresh_per_second=4) as progress,
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor,
+    ):
         task = progress.add_task("Getting subtitles", total=len(videos))
-        for video in videos:
-            subs.append(core.get_subs(video, language))
+        futures = [executor.submit(core.get_subs, video, language) for video in videos]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
             progress.advance(task)
-    return list(subs)
+    return [future.result() for future in futures]
 
 
 @app.command()
@@ -187,26 +326,37 @@ def render(
     external_subs: typing.Annotated[
         bool, typer.Option(help="Search for external subs.")
     ] = False,
+    reencode: typing.Annotated[
+        Optional[bool],
+        typer.Option(
+            help="Re-encode the video parts. By default, parts are stream-copied if they all start on keyframes."
+        ),
+    ] = None,
+    hwaccel: typing.Annotated[
+        Optional[str],
+        typer.Option(
+            help="Hardware acceleration for re-encoding (cuda, qsv, videotoolbox), or 'auto' to detect one.",
+            callback=_validate_hwaccel,
+        ),
+    ] = None,
 ):
     """
     Render supercut
     """
     videos = sorted(videos)
     with Core.from_dir(cache_dir, external_subs=external_subs) as core:
-        video_parts = []
         all_subs = get_all_subs(videos, core, language)
-        for video, subs in zip(videos, all_subs):
-            events = query_events(subs, query, name=name)
-            for event in events:
-                part = ffmpeg.VideoPart(
-                    video=video,
-                    subs=trim_subs(subs, event.start, event.end).to_string("ass"),
-                    start=event.start,
-                    end=event.end,
-                )
-                video_parts.append(part)
+        video_parts = list(
+            build_video_parts(videos, all_subs, query, name=name).values()
+        )
 
-        ffmpeg.supercut_free(video_parts, output=output)
+        ffmpeg.supercut_free(
+            video_parts,
+            output=output,
+            reencode=reencode,
+            hwaccel=hwaccel,
+            keyframe_times=core.get_keyframe_times,
+        )
 
 
 @app.command()
@@ -235,18 +385,13 @@ def export_mlt(
     """
     videos = sorted(videos)
     with Core.from_dir(cache_dir, external_subs=external_subs) as core:
-        video_parts = []
         all_subs = get_all_subs(videos, core, language)
-        for video, subs in zip(videos, all_subs):
-            events = query_events(subs, query, name=name)
-            for event in events:
-                part = ffmpeg.VideoPart(
-                    video=video,
-                    subs=trim_subs(subs, event.start, event.end).to_string("ass"),
-                    start=event.start,
-                    end=event.end,
-                )
-                video_parts.append(part)
+        # The project refers to the source videos, subs and all.
+        video_parts = list(
+            build_video_parts(
+                videos, all_subs, query, name=name, with_subs=False
+            ).values()
+        )
 
     output.write_text(mlt.write_mlt(video_parts))
 
@@ -279,9 +424,7 @@ def list_subs(
             query_events(subs, query, name=name) for subs in all_subs
         )
 
-    for i, event in enumerate(events):
-        text = event.plaintext.replace("\n", " ").replace("  ", " ")
-        print(f"{i:-4} | {event.name}: {text}")
+    sys.stdout.writelines(format_list(events))
 
 
 @app.command(name="names")
@@ -304,14 +447,12 @@ def list_names(
     ] = False,
 ):
     """Show all speaker names in the subtitles"""
-    names: defaultdict[str, int] = defaultdict(int)
+    names: Counter[str] = Counter()
 
     with Core.from_dir(cache_dir, external_subs=external_subs) as core:
         all_subs = get_all_subs(videos, core, language)
         for subs in all_subs:
-            events = query_events(subs, query)
-            for event in events:
-                names[event.name] += 1
+            names.update(event.name for event in query_events(subs, query))
 
     print_names(names)
 
@@ -360,27 +501,89 @@ def edit_create(
             query_events(subs, query, name=name) for subs in all_subs
         )
 
-    list_text = io.StringIO()
-    for i, event in enumerate(events):
-        text = event.plaintext.replace("\n", " ").replace("  ", " ")
-        print(f"{i:-4} | {event.name}: {text}", file=list_text)
+    with (
+        contextlib.nullcontext(sys.stdout)
+        if listfile is None
+        else listfile.open("w", encoding="utf8")
+    ) as out:
+        out.writelines(format_list(events))
+
+
+def iter_matches(
+    videos: list[Path],
+    all_subs: list[pysubs2.SSAFile],
+    query: str,
+    *,
+    name: str | None = None,
+) -> typing.Iterator[tuple[Path, pysubs2.SSAFile, pysubs2.SSAEvent]]:
+    """
+    Yield the matching events of all the videos, in the order `list` numbers them.
+    """
+    for video, subs in zip(videos, all_subs):
+        for event in query_events(subs, query, name=name):
+            yield video, subs, event
+
+
+def build_video_parts(
+    videos: list[Path],
+    all_subs: list[pysubs2.SSAFile],
+    query: str,
+    *,
+    name: str | None = None,
+    only: typing.Container[int] | None = None,
+    with_subs: bool = True,
+) -> dict[int, ffmpeg.VideoPart]:
+    """
+    Build the video parts of the matching events, keyed by their `list` index.
 
-    if listfile is None:
-        print(list_text.getvalue())
-    else:
-        listfile.write_text(list_text.getvalue())
+    If `only` is given, the parts for other indices are skipped.
+    Without `with_subs`, the parts get empty subs instead of trimmed ones.
+    """
+    parts = {}
+    trimmers: dict[Path, typing.Callable[[int, int], pysubs2.SSAFile]] = {}
+    for i, (video, subs, event) in enumerate(
+        iter_matches(videos, all_subs, query, name=name)
+    ):
+        if only is not None and i not in only:
+            continue
+        if not with_subs:
+            part_subs = pysubs2.SSAFile()
+        else:
+            if video not in trimmers:
+                trimmers[video] = subs_trimmer(subs)
+            part_subs = trimmers[video](event.start, event.end)
+        parts[i] = ffmpeg.VideoPart(
+            video=video,
+            subs=part_subs,
+            start=event.start,
+            end=event.end,
+        )
+    return parts
+
+
+# The first word of every line that isn't blank or commented-out.
+_LIST_INDEX_RE = re.compile(rb"^[ \t]*([^\s#]\S*)", re.MULTILINE)
 
 
 def parse_list(listfile: Path) -> list[int]:
-    indices = []
-    for line in listfile.read_text().splitlines():
-        if not line:
-            continue
-        if line.lstrip().startswith("#"):
-            continue
-        indices.append(int(line.lstrip().partition(" ")[0]))
+    return [int(m[1]) for m in _LIST_INDEX_RE.finditer(listfile.read_bytes())]
 
-    return indices
+
+def resolve_list_order(order: list[int], count: int) -> list[int]:
+    """
+    Check the indices of an edit list against the number of matches.
+
+    Like list indices, negative ones count from the end.
+    """
+    resolved = []
+    for i in order:
+        if not -count <= i < count:
+            raise typer.BadParameter(
+                f"index {i} is out of range, the query has {count} matches",
+                param_hint="'--listfile'",
+            )
+        resolved.append(i % count)
+    return resolved
 
 
 @edit_app.command(name="preview")
@@ -410,27 +613,17 @@ def edit_preview(
     videos = sorted(videos)
     new_order = parse_list(listfile)
 
-    playlist = []
     with Core.from_dir(cache_dir, external_subs=external_subs) as core:
-        video_parts = []
         all_subs = get_all_subs(videos, core, language)
-        for video, subs in zip(videos, all_subs):
-            events = query_events(subs, query, name=name)
-            for event in events:
-                part = (video, event.start, event.end)
-                video_parts.append(part)
-
-        video_parts = [video_parts[i] for i in new_order]
+        matches = [
+            (video, event.start, event.end)
+            for video, _, event in iter_matches(videos, all_subs, query, name=name)
+        ]
+        new_order = resolve_list_order(new_order, len(matches))
 
-        for video, start, stop in video_parts:
-            playlist.append(f"#EXTVLCOPT:start-time={start/1000}")
-            playlist.append(f"#EXTVLCOPT:stop-time={stop/1000}")
-            if language:
-                playlist.append(f"#EXTVLCOPT:sub-language={language}")
-            playlist.append(str(video.absolute()))
+        video_parts = [matches[i] for i in new_order]
 
-        full_playlist = "\n".join(playlist)
-        vlc.view_playlist(full_playlist)
+        vlc.view_playlist(vlc.create_playlist(video_parts, language=language))
 
 
 @edit_app.command(name="render")
@@ -454,6 +647,19 @@ def edit_render(
     external_subs: typing.Annotated[
         bool, typer.Option(help="Search for external subs.")
     ] = False,
+    reencode: typing.Annotated[
+        Optional[bool],
+        typer.Option(
+            help="Re-encode the video parts. By default, parts are stream-copied if they all start on keyframes."
+        ),
+    ] = None,
+    hwaccel: typing.Annotated[
+        Optional[str],
+        typer.Option(
+            help="Hardware acceleration for re-encoding (cuda, qsv, videotoolbox), or 'auto' to detect one.",
+            callback=_validate_hwaccel,
+        ),
+    ] = None,
 ):
     """
     Render supercut based on edit list.
@@ -462,31 +668,40 @@ def edit_render(
     new_order = parse_list(listfile)
 
     with Core.from_dir(cache_dir, external_subs=external_subs) as core:
-        video_parts = []
         all_subs = get_all_subs(videos, core, language)
-        for video, subs in zip(videos, all_subs):
-            events = query_events(subs, query, name=name)
-            for event in events:
-                part = ffmpeg.VideoPart(
-                    video=video,
-                    subs=trim_subs(subs, event.start, event.end).to_string("ass"),
-                    start=event.start,
-                    end=event.end,
-                )
-                video_parts.append(part)
-
-        video_parts = [video_parts[i] for i in new_order]
-
-        ffmpeg.supercut_free(video_parts, output=output)
+        match_count = sum(
+            len(query_events(subs, query, name=name)) for subs in all_subs
+        )
+        new_order = resolve_list_order(new_order, match_count)
+        # Only the lines the edit list uses are trimmed, the rest are just counted.
+        parts_by_index = build_video_parts(
+            videos, all_subs, query, name=name, only=set(new_order)
+        )
+        video_parts = [parts_by_index[i] for i in new_order]
+
+        ffmpeg.supercut_free(
+            video_parts,
+            output=output,
+            reencode=reencode,
+            hwaccel=hwaccel,
+            keyframe_times=core.get_keyframe_times,
+        )
 
 
 @util_app.command()
 def hardcode_subs(
     video: typing.Annotated[Path, typer.Argument(help="The video to hardcode subs in")],
     output: typing.Annotated[Path, typer.Option(help="Ouptut file")],
+    hwaccel: typing.Annotated[
+        Optional[str],
+        typer.Option(
+            help="Hardware acceleration for re-encoding (cuda, qsv, videotoolbox), or 'auto' to detect one.",
+            callback=_validate_hwaccel,
+        ),
+    ] = None,
 ):
     """Hardcode the subtitles into the video frames."""
-    ffmpeg.hardcode_subs(video, output=output)
+    ffmpeg.hardcode_subs(video, output=output, hwaccel=hwaccel)
 
 
 @app.command()
@@ -496,7 +711,28 @@ def check():
 
 
 @app.callback()
-def callback():
+def callback(
+    ffmpeg_threads: typing.Annotated[
+        Optional[int],
+        typer.Option(
+            help="Threads for each re-encoding ffmpeg run. By default, ffmpeg decides.",
+            envvar=ffmpeg.THREADS_ENV_VAR,
+            min=1,
+        ),
+    ] = None,
+    jobs: typing.Annotated[
+        Optional[int],
+        typer.Option(
+            help="Videos to extract subtitles from at once. By default, twice the CPU count.",
+            envvar=JOBS_ENV_VAR,
+            min=1,
+        ),
+    ] = None,
+):
+    global JOBS
+    ffmpeg.FFMPEG_THREADS = ffmpeg_threads
+    JOBS = jobs
+
     has_ffmpeg = ffmpeg.ensure_ffmpeg()
     has_vlc = vlc.ensure_vlc()
 
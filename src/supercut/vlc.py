@@ -1,7 +1,8 @@
 import contextlib
+import functools
 import os
-import platform
 import subprocess
+import sys
 import tempfile
 from pathlib import Path
 from typing import Iterator
@@ -12,21 +13,46 @@ WINDOWS_DEFAULT_PATH = r"C:\Program Files\VideoLAN\VLC\vlc.exe"
 
 VLC_ENV_VAR = "SUPERCUT_VLC_PATH"
 
+_IS_WINDOWS = sys.platform == "win32"
 
+# Generous, as VLC's first run builds its plugin cache.
+ENSURE_VLC_TIMEOUT = 30
+
+
+@functools.cache
 def get_vlc() -> str:
     if vlc := os.environ.get(VLC_ENV_VAR, None):
         return vlc
 
-    if platform.system() == "Windows":
+    if _IS_WINDOWS:
         if os.path.isfile(WINDOWS_DEFAULT_PATH):
             return WINDOWS_DEFAULT_PATH
 
     return "vlc"
 
 
+def _run_vlc(args: list[str], timeout: float | None = None, quiet: bool = False):
+    # With `quiet`, VLC's console output is discarded. Playback keeps it, as it
+    # is the only explanation we get when VLC fails to play something.
+    output = subprocess.DEVNULL if quiet else None
+    subprocess.run(
+        [get_vlc(), *args],
+        stdout=output,
+        stderr=output,
+        timeout=timeout,
+        check=True,
+    )
+
+
 def ensure_vlc() -> bool:
+    # `--version` exits before loading any modules. On Windows it opens a
+    # console window and waits for a key instead, so we boot VLC there.
+    if _IS_WINDOWS:
+        args = ["-I", "dummy", "vlc://quit"]
+    else:
+        args = ["--version"]
     try:
-        subprocess.check_call([get_vlc(), "-I", "dummy", "vlc://quit"])
+        _run_vlc(args, timeout=ENSURE_VLC_TIMEOUT, quiet=True)
         return True
     except Exception:
         return False
@@ -38,33 +64,54 @@ def supercut(video: Path, sections: list[tuple[float, float]]):
         cuts.extend(
             [f":start-time={start}", f":stop-time={end}", str(video.absolute())]
         )
-    cmd = [get_vlc(), "--fullscreen", "--no-osd", *cuts, "vlc://quit"]
-    rich.print(cmd)
-    subprocess.check_call(cmd)
+    args = ["--fullscreen", "--no-osd", *cuts, "vlc://quit"]
+    rich.print([get_vlc(), *args])
+    _run_vlc(args)
+
+
+def create_playlist(
+    sections: list[tuple[Path, int, int]], language: str | None = None
+) -> str:
+    """Create a playlist of `(video, start, stop)` sections, with times in ms."""
+    # Everything but the times is the same for all the sections of a video.
+    tails: dict[Path, str] = {}
+    for video, _, _ in sections:
+        if video not in tails:
+            tail = str(video.absolute())
+            if language:
+                tail = f"#EXTVLCOPT:sub-language={language}\n{tail}"
+            tails[video] = tail
+
+    return "\n".join(
+        f"#EXTVLCOPT:start-time={start/1000}\n#EXTVLCOPT:stop-time={stop/1000}\n"
+        f"{tails[video]}"
+        for video, start, stop in sections
+    )
 
 
 def create_supercut_playlist(
     video: Path, sections: list[tuple[int, int]], language: str | None = None
 ) -> str:
-    lines = []
-    for start, stop in sections:
-        lines.append(f"#EXTVLCOPT:start-time={start/1000}")
-        lines.append(f"#EXTVLCOPT:stop-time={stop/1000}")
-        if language:
-            lines.append(f"#EXTVLCOPT:sub-language={language}")
-        lines.append(str(video.absolute()))
+    return create_playlist(
+        [(video, start, stop) for start, stop in sections], language=language
+    )
 
-    return "\n".join(lines)
 
+@contextlib.contextmanager
+def _temp_playlist(playlist: str) -> Iterator[Path]:
+    # A single file is cheaper to create and clean up than a directory.
+    fd, path = tempfile.mkstemp(suffix=".m3u8")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(playlist.encode())
+        yield Path(path)
+    finally:
+        os.unlink(path)
 
-def view_playlist(playlist: str):
-    with tempfile.TemporaryDirectory() as tempdir:
-        playlist_file = Path(tempdir) / "playlist.m3u8"
-        playlist_file.write_text(playlist)
 
-        subprocess.check_call(
-            [get_vlc(), "--fullscreen", "--no-osd", str(playlist_file), "vlc://quit"]
-        )
+def view_playlist(playlist: str):
+    with _temp_playlist(playlist) as playlist_file:
+        _run_vlc(["--fullscreen", "--no-osd", str(playlist_file), "vlc://quit"])
 
 
 def supercut_playlist(
@@ -78,14 +125,12 @@ def supercut_playlist(
     @contextlib.contextmanager
     def _output_path() -> Iterator[Path]:
         if output is not None:
+            output.write_bytes(playlist.encode())
             yield output
 
         else:
-            with tempfile.TemporaryDirectory() as tempdir:
-                yield Path(tempdir) / "playlist.m3u8"
+            with _temp_playlist(playlist) as playlist_file:
+                yield playlist_file
 
     with _output_path() as output_path:
-        output_path.write_text(playlist)
-        subprocess.check_call(
-            [get_vlc(), "--fullscreen", "--no-osd", str(output_path), "vlc://quit"]
-        )
+        _run_vlc(["--fullscreen", "--no-osd", str(output_path), "vlc://quit"])
@@ -0,0 +1,150 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pysubs2  # type: ignore[import-untyped]
+import pytest
+
+from supercut import ffmpeg
+
+
+def _part(video: Path, start: int, end: int) -> ffmpeg.VideoPart:
+    return ffmpeg.VideoPart(video=video, subs=pysubs2.SSAFile(), start=start, end=end)
+
+
+@pytest.fixture
+def commands(monkeypatch) -> list[list[str]]:
+    """Record the ffmpeg commands instead of running them."""
+    recorded: list[list[str]] = []
+
+    def fake_progress(args, progress_key, progress_converter, input=None):
+        recorded.append(list(args))
+        yield progress_converter(b"0")
+
+    monkeypatch.setattr(ffmpeg, "ffmpeg_progress_iterator", fake_progress)
+    monkeypatch.setattr(
+        ffmpeg, "run_ffmpeg", lambda args, input=None: recorded.append(list(args))
+    )
+    return recorded
+
+
+@pytest.fixture
+def fake_probe(monkeypatch) -> dict[str, dict]:
+    streams = {
+        "small.mkv": {"width": 320, "height": 240},
+        "large.mkv": {"width": 640, "height": 360},
+    }
+
+    def probe(video: Path) -> dict:
+        return {
+            "streams": [
+                {"codec_type": "video", **streams[video.name]},
+                {
+                    "codec_type": "audio",
+                    "sample_rate": "44100",
+                    "channel_layout": "stereo",
+                },
+            ]
+        }
+
+    monkeypatch.setattr(ffmpeg, "probe", probe)
+    return streams
+
+
+def test_concat_file_quoting():
+    video = Path("/videos/it's here.mkv")
+    assert ffmpeg._concat_file(video) == "file '/videos/it'\\''s here.mkv'"
+
+
+def test_concat_file_is_absolute(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert ffmpeg._concat_file(Path("video.mkv")) == f"file '{tmp_path}/video.mkv'"
+
+
+def test_threads_args(monkeypatch):
+    monkeypatch.delenv(ffmpeg.THREADS_ENV_VAR, raising=False)
+    monkeypatch.setattr(ffmpeg, "FFMPEG_THREADS", None)
+    assert ffmpeg._threads_args() == []
+
+    monkeypatch.setenv(ffmpeg.THREADS_ENV_VAR, "3")
+    assert ffmpeg._threads_args() == ["-threads", "3"]
+
+    monkeypatch.setattr(ffmpeg, "FFMPEG_THREADS", 5)
+    assert ffmpeg._threads_args() == ["-threads", "5"]
+
+
+def test_reencode_normalizes_resolutions(tmp_path, commands, fake_probe):
+    parts = [
+        _part(Path("small.mkv"), 0, 1000),
+        _part(Path("large.mkv"), 2000, 3000),
+    ]
+    list(ffmpeg.render_reencoded(parts, tmp_path / "subs.ssa", tmp_path / "out.mkv"))
+
+    [command] = commands
+    filters = command[command.index("-filter_complex") + 1]
+    for i in range(len(parts)):
+        assert (
+            f"[{i}:v:0]scale=320:240:force_original_aspect_ratio=decrease,"
+            f"pad=320:240:(ow-iw)/2:(oh-ih)/2,setsar=1," in filters
+        )
+        assert f"[{i}:a:0]aresample=44100,aformat=channel_layouts=stereo," in filters
+    assert filters.endswith("[v0][a0][v1][a1]concat=n=2:v=1:a=1[video][audio]")
+
+
+def test_reencode_renders_in_batches(tmp_path, commands, fake_probe, monkeypatch):
+    monkeypatch.setattr(ffmpeg, "MAX_PARTS_PER_RUN", 2)
+    parts = [_part(Path("small.mkv"), i * 1000, i * 1000 + 500) for i in range(5)]
+    subs = tmp_path / "subs.ssa"
+    list(ffmpeg.render_reencoded(parts, subs, tmp_path / "out.mkv"))
+
+    *batches, concat = commands
+    assert [command.count("-i") for command in batches] == [2, 2, 1]
+    assert all(str(subs) not in command for command in batches)
+    assert str(subs) in concat
+    assert "-filter_complex" not in concat
+
+
+@pytest.mark.skipif(
+    shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+    reason="needs ffmpeg",
+)
+def test_reencode_mixed_resolutions(tmp_path):
+    videos = []
+    for size in ["320x240", "640x360"]:
+        video = tmp_path / f"{size}.mkv"
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"testsrc=size={size}:duration=2",
+                "-f",
+                "lavfi",
+                "-i",
+                "sine=duration=2",
+                str(video),
+            ],
+            check=True,
+        )
+        videos.append(video)
+
+    output = tmp_path / "out.mkv"
+    parts = [_part(video, 500, 1500) for video in videos]
+    ffmpeg.supercut_free(parts, output, reencode=True)
+
+    streams = ffmpeg.probe(output)["streams"]
+    video_stream = next(s for s in streams if s["codec_type"] == "video")
+    assert (video_stream["width"], video_stream["height"]) == (320, 240)
+
+
+@pytest.mark.parametrize("hwaccel", [None, "auto", *ffmpeg.HWACCEL_ENCODERS])
+def test_validate_hwaccel_accepts_known_methods(hwaccel):
+    assert ffmpeg.validate_hwaccel(hwaccel) == hwaccel
+
+
+def test_validate_hwaccel_rejects_unknown_methods():
+    with pytest.raises(ValueError, match="'vulkan'"):
+        ffmpeg.validate_hwaccel("vulkan")
@@ -0,0 +1,164 @@
+import random
+from copy import copy
+from pathlib import Path
+
+import pysubs2  # type: ignore[import-untyped]
+import pytest
+import typer
+
+from supercut import ffmpeg, supercut
+
+
+def _subs(*times: tuple[int, int]) -> pysubs2.SSAFile:
+    subs = pysubs2.SSAFile()
+    for i, (start, end) in enumerate(times):
+        subs.events.append(pysubs2.SSAEvent(start=start, end=end, text=f"event {i}"))
+    return subs
+
+
+def _times(subs: pysubs2.SSAFile) -> list[tuple[int, int, str]]:
+    return [(event.start, event.end, event.text) for event in subs.events]
+
+
+def _linear_trim(subs: pysubs2.SSAFile, start: int, end: int) -> pysubs2.SSAFile:
+    """Trim by scanning every event, to check `subs_trimmer` against."""
+    trimmed = copy(subs)
+    trimmed.events = []
+    for event in subs.events:
+        if event.start < end and event.end > start:
+            event = event.copy()
+            event.start = max(event.start - start, 0)
+            event.end = min(event.end - start, end - start)
+            trimmed.events.append(event)
+    return trimmed
+
+
+def test_subs_trimmer_finds_long_events_starting_before_the_range():
+    # The long event starts well before the range, while the short ones next
+    # to it don't reach it.
+    subs = _subs((0, 10_000), (8_000, 8_500), (9_000, 9_500), (12_000, 13_000))
+    trim = supercut.subs_trimmer(subs)
+
+    assert _times(trim(9_600, 12_500)) == [
+        (0, 400, "event 0"),
+        (2_400, 2_900, "event 3"),
+    ]
+
+
+def test_subs_trimmer_keeps_the_original_order():
+    subs = _subs((5_000, 6_000), (1_000, 7_000), (5_000, 5_500), (0, 2_000))
+    trim = supercut.subs_trimmer(subs)
+
+    assert [event.text for event in trim(4_000, 8_000).events] == [
+        "event 0",
+        "event 1",
+        "event 2",
+    ]
+
+
+def test_subs_trimmer_does_not_modify_the_subs():
+    subs = _subs((0, 1_000), (500, 2_000))
+    before = _times(subs)
+    supercut.subs_trimmer(subs)(700, 1_500)
+    assert _times(subs) == before
+
+
+def test_subs_trimmer_matches_linear_trim():
+    rng = random.Random(232)
+    times = []
+    for _ in range(200):
+        start = rng.randrange(100_000)
+        times.append((start, start + rng.randrange(1, 8_000)))
+    subs = _subs(*times)
+    trim = supercut.subs_trimmer(subs)
+
+    for _ in range(100):
+        start = rng.randrange(100_000)
+        end = start + rng.randrange(1, 10_000)
+        assert _times(trim(start, end)) == _times(_linear_trim(subs, start, end))
+
+
+def _part(subs: pysubs2.SSAFile, start: int, end: int) -> ffmpeg.VideoPart:
+    return ffmpeg.VideoPart(video=Path("video.mkv"), subs=subs, start=start, end=end)
+
+
+def test_merge_subs_offsets_each_part_by_the_previous_durations():
+    parts = [
+        _part(_subs((100, 900)), 5_000, 6_000),
+        _part(_subs((0, 500)), 20_000, 22_500),
+        _part(_subs((200, 300)), 0, 1_000),
+    ]
+
+    assert _times(ffmpeg.merge_subs(parts)) == [
+        (100, 900, "event 0"),
+        (1_000, 1_500, "event 0"),
+        (3_700, 3_800, "event 0"),
+    ]
+
+
+def test_merge_subs_shifts_shared_events_separately():
+    subs = _subs((100, 200))
+    parts = [_part(subs, 0, 1_000), _part(subs, 0, 1_000)]
+
+    merged = ffmpeg.merge_subs(parts)
+
+    assert _times(merged) == [(100, 200, "event 0"), (1_100, 1_200, "event 0")]
+    assert _times(subs) == [(100, 200, "event 0")]
+
+
+def test_merge_subs_takes_info_and_styles_from_the_first_part():
+    first = _subs((0, 100))
+    first.info["Title"] = "first"
+    first.styles["Default"] = pysubs2.SSAStyle(fontsize=10)
+    second = _subs((0, 100))
+    second.info["Title"] = "second"
+    second.styles["Default"] = pysubs2.SSAStyle(fontsize=20)
+    second.styles["Other"] = pysubs2.SSAStyle(fontsize=30)
+
+    merged = ffmpeg.merge_subs([_part(first, 0, 100), _part(second, 0, 100)])
+
+    assert merged.info["Title"] == "first"
+    assert merged.styles["Default"].fontsize == 10
+    assert merged.styles["Other"].fontsize == 30
+
+
+def test_parse_list_skips_comments_and_blank_lines(tmp_path):
+    listfile = tmp_path / "list.txt"
+    listfile.write_text(
+        "# A comment\n"
+        "   3 | 0:00:01.00 - 0:00:02.00 | Hello\n"
+        "\n"
+        "   \n"
+        "  # An indented comment\n"
+        "12 | 0:00:03.00 - 0:00:04.00 | World\n"
+        "\t7\n"
+    )
+
+    assert supercut.parse_list(listfile) == [3, 12, 7]
+
+
+def test_parse_list_reads_format_list_output(tmp_path):
+    subs = _subs((0, 1_000), (2_000, 3_000))
+    listfile = tmp_path / "list.txt"
+    listfile.write_text("".join(supercut.format_list(subs.events)))
+
+    assert supercut.parse_list(listfile) == [0, 1]
+
+
+@pytest.mark.parametrize("line", ["three | Hello", "3| Hello", "-"])
+def test_parse_list_rejects_malformed_lines(tmp_path, line):
+    listfile = tmp_path / "list.txt"
+    listfile.write_text(f"1 | Fine\n{line}\n")
+
+    with pytest.raises(ValueError):
+        supercut.parse_list(listfile)
+
+
+def test_resolve_list_order_counts_negative_indices_from_the_end():
+    assert supercut.resolve_list_order([0, -1, 2, -3], 3) == [0, 2, 2, 0]
+
+
+@pytest.mark.parametrize("index", [3, -4])
+def test_resolve_list_order_rejects_out_of_range_indices(index):
+    with pytest.raises(typer.BadParameter, match=f"index {index} is out of range"):
+        supercut.resolve_list_order([0, index], 3)
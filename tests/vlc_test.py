@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from supercut import vlc
+
+
+def test_create_playlist_sections_from_several_videos(tmp_path):
+    first, second = tmp_path / "first.mkv", tmp_path / "second.mkv"
+    playlist = vlc.create_playlist(
+        [(first, 1_500, 2_250), (second, 0, 1_000), (first, 3_000, 4_000)],
+        language="eng",
+    )
+
+    assert playlist.splitlines() == [
+        "#EXTVLCOPT:start-time=1.5",
+        "#EXTVLCOPT:stop-time=2.25",
+        "#EXTVLCOPT:sub-language=eng",
+        str(first),
+        "#EXTVLCOPT:start-time=0.0",
+        "#EXTVLCOPT:stop-time=1.0",
+        "#EXTVLCOPT:sub-language=eng",
+        str(second),
+        "#EXTVLCOPT:start-time=3.0",
+        "#EXTVLCOPT:stop-time=4.0",
+        "#EXTVLCOPT:sub-language=eng",
+        str(first),
+    ]
+
+
+def test_create_supercut_playlist_matches_create_playlist():
+    video = Path("video.mkv")
+    sections = [(0, 1_000), (2_000, 3_500)]
+    assert vlc.create_supercut_playlist(video, sections) == vlc.create_playlist(
+        [(video, start, stop) for start, stop in sections]
+    )